@@ -1,4 +1,5 @@
 #include <nanobind/nanobind.h>
+#include <nanobind/ndarray.h>
 #include <nanobind/stl/string.h>
 #include <nanobind/stl/vector.h>
 #include <nanobind/stl/tuple.h>
@@ -181,6 +182,35 @@ using Random64 = Jakube::Kiss64Random<uint64_t>;
 using SingleThreadPolicy = Jakube::JakubeIndexSingleThreadedBuildPolicy;
 using HammingIndex = Jakube::JakubeIndex<int, int32_t, Jakube::Hamming, Random64>;
 
+// Flat scan over single-word packed codes, for callers that keep the codes
+// themselves instead of querying an index
+using CodeArray = nb::ndarray<const uint32_t, nb::ndim<1>, nb::c_contig, nb::device::cpu>;
+using DistanceArray = nb::ndarray<nb::numpy, uint8_t, nb::ndim<1>>;
+
+inline uint8_t hamming32(uint32_t a, uint32_t b) {
+#ifndef _MSC_VER
+  return static_cast<uint8_t>(jakubelib_popcount(a ^ b));
+#else
+  return static_cast<uint8_t>(Jakube::Hamming::cole_popcount(a ^ b));
+#endif
+}
+
+DistanceArray hamming_scan(CodeArray codes, uint32_t query) {
+  const size_t n = codes.shape(0);
+  const uint32_t* data = codes.data();
+  uint8_t* out = new uint8_t[n];
+  
+  {
+    nb::gil_scoped_release release;
+    for (size_t i = 0; i < n; i++) {
+      out[i] = hamming32(data[i], query);
+    }
+  }
+  
+  nb::capsule owner(out, [](void* p) noexcept { delete[] static_cast<uint8_t*>(p); });
+  return DistanceArray(out, {n}, owner);
+}
+
 template<typename IndexType, typename ValueType>
 void bind_index(nb::module_& m, const char* python_name, const char* metric_name) {
   const std::string doc = std::string("Jakube index using the ") + metric_name + " metric.";
@@ -206,9 +236,11 @@ void bind_index(nb::module_& m, const char* python_name, const char* metric_name
 
 } // namespace
 
-NB_MODULE(jakube_ext, m) {
+NB_MODULE(jakube, m) {
   m.doc() = "Python bindings for the Jakube approximate nearest neighbours library (Hamming distance only).";
   
   // Only bind Hamming index
   bind_index<HammingIndex, int32_t>(m, "HammingIndex", "Hamming");
+  
+  m.def("hamming_scan", &hamming_scan, "codes"_a, "query"_a, "Return the Hamming distance from query to every uint32 code as a uint8 array.");
 }
@@ -4,17 +4,17 @@ Enhanced Movie Index Builder - Builds a comprehensive TMDB movie database
 """
 import argparse
 import asyncio
-import json
 import os
+import random
 import sys
 import time
-from collections import OrderedDict
 from pathlib import Path
-from typing import Dict, List, Optional, Sequence, Set
+from typing import Dict, List, Optional, Sequence, Set, Tuple
 import logging
 
 import httpx
 import numpy as np
+import orjson
 from tqdm.asyncio import tqdm
 from aiolimiter import AsyncLimiter
 
@@ -37,41 +37,102 @@ BATCH_SIZE = 10  # Number of concurrent requests
 RATE_LIMIT = 40  # Requests per 10 seconds
 RETRY_ATTEMPTS = 3
 RETRY_DELAY = 5  # seconds
+MAX_RETRY_DELAY = 60  # seconds, cap for the exponential backoff
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
 
 class TMDBCrawler:
     """Manages crawling the TMDB API with rate limiting and retries"""
     
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, force_refresh: bool = False):
         self.api_key = api_key
+        self.force_refresh = force_refresh
         self.rate_limiter = AsyncLimiter(RATE_LIMIT, 10.0)
+        self.sem = asyncio.Semaphore(BATCH_SIZE)
         self.client: Optional[httpx.AsyncClient] = None
         self.movie_cache: Dict[int, Dict] = {}
+        # Movie IDs already returned by fetch_year, shared across all years
+        self.seen: Set[int] = set()
+        # (year, page) -> movie IDs on that discover page, plus TMDB's page
+        # count per year, so repeat runs can rebuild pages from movie_cache
+        self.page_cache: Dict[Tuple[int, int], List[int]] = {}
+        self.year_total_pages: Dict[int, int] = {}
         self.cache_file = Path("movie_cache.json")
+        self.page_cache_file = Path("page_cache.json")
         self._load_cache()
 
     def _load_cache(self):
-        """Load previously cached movies"""
+        """Load previously cached movies and discover pages"""
         if self.cache_file.exists():
             try:
-                with open(self.cache_file, 'r') as f:
-                    cache = json.load(f)
-                    self.movie_cache = {int(k): v for k, v in cache.items()}
+                cache = orjson.loads(self.cache_file.read_bytes())
+                # JSON object keys are always strings, restore the int movie IDs
+                self.movie_cache = {int(k): v for k, v in cache.items()}
                 logger.info(f"Loaded {len(self.movie_cache)} movies from cache")
             except Exception as e:
                 logger.error(f"Error loading cache: {e}")
 
+        # Loaded even on a forced refresh: fetch_year only discards the pages of
+        # the years it re-crawls, so other years survive the next save
+        if self.page_cache_file.exists():
+            try:
+                cache = orjson.loads(self.page_cache_file.read_bytes())
+                for key, movie_ids in cache["pages"].items():
+                    year, page = key.split(":")
+                    self.page_cache[(int(year), int(page))] = movie_ids
+                self.year_total_pages = {int(k): v for k, v in cache["total_pages"].items()}
+                logger.info(f"Loaded {len(self.page_cache)} discover pages from cache")
+            except Exception as e:
+                logger.error(f"Error loading page cache: {e}")
+
     def _save_cache(self):
-        """Save cached movies to disk"""
+        """Save cached movies and discover pages to disk"""
         try:
-            with open(self.cache_file, 'w') as f:
-                json.dump(self.movie_cache, f)
+            data = orjson.dumps(self.movie_cache, option=orjson.OPT_NON_STR_KEYS)
+            self.cache_file.write_bytes(data)
             logger.info(f"Saved {len(self.movie_cache)} movies to cache")
+
+            self.page_cache_file.write_bytes(orjson.dumps({
+                "pages": {f"{year}:{page}": ids for (year, page), ids in self.page_cache.items()},
+                "total_pages": self.year_total_pages,
+            }, option=orjson.OPT_NON_STR_KEYS))
+            logger.info(f"Saved {len(self.page_cache)} discover pages to cache")
         except Exception as e:
             logger.error(f"Error saving cache: {e}")
 
+    def _cached_page(self, year: int, page: int) -> Optional[List[Dict]]:
+        """Rebuild a discover page from the caches, or None if it must be fetched"""
+        movie_ids = self.page_cache.get((year, page))
+        if movie_ids is None:
+            return None
+        try:
+            return [self.movie_cache[movie_id] for movie_id in movie_ids]
+        except KeyError:
+            return None
+
+    def _forget_year(self, year: int) -> None:
+        """Drop a year's cached discover pages so they are fetched again"""
+        self.year_total_pages.pop(year, None)
+        for key in [key for key in self.page_cache if key[0] == year]:
+            del self.page_cache[key]
+
+    def _store_page(self, year: int, page: int, movies: List[Dict]) -> None:
+        """Record a freshly fetched discover page in the caches"""
+        movie_ids = []
+        for movie in movies:
+            movie_id = movie.get("id")
+            if movie_id:
+                # Store movie with genre_ids, vote_average, and original_language
+                self.movie_cache[movie_id] = movie
+                movie_ids.append(movie_id)
+        self.page_cache[(year, page)] = movie_ids
+
     async def __aenter__(self):
-        transport = httpx.AsyncHTTPTransport(retries=RETRY_ATTEMPTS)
-        self.client = httpx.AsyncClient(timeout=30.0, transport=transport)
+        # HTTP/2 multiplexes the concurrent page requests over a few connections
+        self.client = httpx.AsyncClient(
+            timeout=30.0,
+            http2=True,
+            limits=httpx.Limits(max_connections=RATE_LIMIT, max_keepalive_connections=RATE_LIMIT)
+        )
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
@@ -79,37 +140,42 @@ class TMDBCrawler:
             await self.client.aclose()
         self._save_cache()
 
-    async def fetch_page(
-        self,
-        endpoint: str,
-        page: int,
-        extra_params: Optional[Dict] = None
-    ) -> Dict:
-        """Fetch a single page with retries and rate limiting"""
+    async def fetch_page(self, endpoint: str, params: Dict) -> Dict:
+        """Fetch a single page with retries and rate limiting using the full query params"""
         if not self.client:
             raise RuntimeError("Client not initialized")
 
-        params = {
-            "api_key": self.api_key,
-            "language": "en-US",
-            "page": page
-        }
-        if extra_params:
-            params.update(extra_params)
-
         url = f"{TMDB_API_ROOT}/{endpoint}"
         
-        async with self.rate_limiter:
-            try:
-                response = await self.client.get(url, params=params)
-                response.raise_for_status()
-                return response.json()
-            except httpx.HTTPStatusError as e:
-                logger.error(f"HTTP error fetching {e.request.url}: {e}")
-                raise
-            except httpx.RequestError as e:
-                logger.error(f"Request error fetching {e.request.url}: {e}")
-                raise
+        for attempt in range(RETRY_ATTEMPTS):
+            # Exponential backoff with jitter so retrying pages do not fire in lockstep
+            delay = min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** attempt + random.uniform(0, 1))
+
+            async with self.rate_limiter:
+                async with self.sem:
+                    try:
+                        response = await self.client.get(url, params=params)
+                        response.raise_for_status()
+                        return response.json()
+                    except httpx.HTTPStatusError as e:
+                        status = e.response.status_code
+                        if status not in RETRYABLE_STATUS_CODES or attempt == RETRY_ATTEMPTS - 1:
+                            logger.error(f"HTTP error fetching {e.request.url}: {e}")
+                            raise
+
+                        # Wait at least as long as the server asks on 429/503
+                        retry_after = e.response.headers.get("Retry-After", "")
+                        if retry_after.isdigit():
+                            delay = max(delay, int(retry_after))
+                        logger.warning(f"HTTP {status} fetching {e.request.url}, retrying in {delay:.1f}s")
+                    except httpx.RequestError as e:
+                        if attempt == RETRY_ATTEMPTS - 1:
+                            logger.error(f"Request error fetching {e.request.url}: {e}")
+                            raise
+                        logger.warning(f"Request error fetching {e.request.url}, retrying in {delay:.1f}s: {e}")
+
+            # Back off outside the semaphore so other pages can proceed
+            await asyncio.sleep(delay)
 
     async def fetch_year(
         self,
@@ -121,50 +187,75 @@ class TMDBCrawler:
         if not self.client:
             raise RuntimeError("Client not initialized")
 
-        params = {
+        # Built once per year; each page only overrides "page", so every
+        # request has the same shape
+        base_params = {
+            "api_key": self.api_key,
+            "language": "en-US",
             "sort_by": "popularity.desc",
-            "include_adult": False,
-            "include_video": False,
+            "include_adult": "false",
+            "include_video": "false",
             "primary_release_year": year,
         }
 
-        dedup: OrderedDict[int, Dict] = OrderedDict()
-        total_pages = None
+        movies: List[Dict] = []
+        results: Dict[int, List[Dict]] = {}
 
-        for batch_start in range(1, max_pages + 1, BATCH_SIZE):
-            batch_end = min(batch_start + BATCH_SIZE, max_pages + 1)
-            tasks = []
+        if self.force_refresh:
+            self._forget_year(year)
 
-            for page in range(batch_start, batch_end):
-                task = self.fetch_page("discover/movie", page, params)
-                tasks.append(task)
+        if year not in self.year_total_pages:
+            # Fetch page 1 on its own to learn how many pages the year has, so
+            # no requests are spent on pages past the end
+            result = await self.fetch_page("discover/movie", {**base_params, "page": 1})
+            self.year_total_pages[year] = result.get("total_pages", max_pages)
+            results[1] = result.get("results", [])
+            self._store_page(year, 1, results[1])
+            if progress_bar:
+                progress_bar.update(1)
 
-            try:
-                results = await asyncio.gather(*tasks)
-                
-                for result in results:
-                    if total_pages is None:
-                        total_pages = min(result.get("total_pages", max_pages), max_pages)
-                    
-                    for movie in result.get("results", []):
-                        movie_id = movie.get("id")
-                        if movie_id:
-                            # Store movie with genre_ids, vote_average, and original_language
-                            if movie_id not in self.movie_cache:
-                                self.movie_cache[movie_id] = movie
-                            dedup[movie_id] = movie
+        total_pages = min(self.year_total_pages[year], max_pages)
 
+        # Pages seen on a previous run are rebuilt from the cache without a request
+        for page in range(1, total_pages + 1):
+            if page in results:
+                continue
+            cached = self._cached_page(year, page)
+            if cached is not None:
+                results[page] = cached
                 if progress_bar:
-                    progress_bar.update(len(tasks))
+                    progress_bar.update(1)
+
+        async def fetch(page: int) -> Dict:
+            result = await self.fetch_page("discover/movie", {**base_params, "page": page})
+            if progress_bar:
+                progress_bar.update(1)
+            return result
+
+        # The remaining pages are requested together; self.sem bounds how many
+        # are in flight, so a slow page does not hold back the others
+        pages = [page for page in range(1, total_pages + 1) if page not in results]
+        fetched = await asyncio.gather(*(fetch(page) for page in pages), return_exceptions=True)
+
+        for page, result in zip(pages, fetched):
+            if isinstance(result, Exception):
+                logger.error(f"Error fetching page {page} of {year}: {result}")
+                continue
+            results[page] = result.get("results", [])
+            self._store_page(year, page, results[page])
 
-                if total_pages and batch_start >= total_pages:
-                    break
+        # Walk pages in order so the output keeps TMDB's popularity ordering
+        for page in sorted(results):
+            for movie in results[page]:
+                movie_id = movie.get("id")
+                # Skip movies already collected by this or another year
+                if not movie_id or movie_id in self.seen:
+                    continue
 
-            except Exception as e:
-                logger.error(f"Error fetching batch {batch_start}-{batch_end}: {e}")
-                continue
+                self.seen.add(movie_id)
+                movies.append(movie)
 
-        return list(dedup.values())
+        return movies
 
 
 async def build_comprehensive_index(
@@ -174,8 +265,9 @@ async def build_comprehensive_index(
     max_pages_per_year: int = 500,
     n_trees: int = 20,
     metric: str = "hamming",
-    n_jobs: int = 4,
-    output_dir: str = "."
+    n_jobs: int = os.cpu_count() or 4,
+    output_dir: str = ".",
+    force_refresh: bool = False
 ) -> None:
     """Build a comprehensive movie index from TMDB data"""
     output_dir = Path(output_dir)
@@ -183,37 +275,53 @@ async def build_comprehensive_index(
 
     total_movies = []
 
-    async with TMDBCrawler(api_key) as crawler:
+    async with TMDBCrawler(api_key, force_refresh=force_refresh) as crawler:
         total_pages = (end_year - start_year + 1) * max_pages_per_year
         
         with tqdm(total=total_pages, desc="Fetching movies") as pbar:
-            for year in range(start_year, end_year + 1):
-                logger.info(f"\nProcessing year {year}...")
-                
-                try:
-                    year_movies = await crawler.fetch_year(
+            # Years are crawled concurrently; the crawler's shared rate limiter
+            # and semaphore keep the overall request rate within TMDB's budget
+            years = range(start_year, end_year + 1)
+            logger.info(f"\nProcessing years {start_year}-{end_year}...")
+
+            year_results = await asyncio.gather(
+                *(
+                    crawler.fetch_year(
                         year,
                         max_pages=max_pages_per_year,
                         progress_bar=pbar
                     )
-                    total_movies.extend(year_movies)
-                    logger.info(f"Found {len(year_movies)} movies from {year}")
-                
-                except Exception as e:
-                    logger.error(f"Error processing year {year}: {e}")
+                    for year in years
+                ),
+                return_exceptions=True
+            )
+
+            for year, year_movies in zip(years, year_results):
+                if isinstance(year_movies, Exception):
+                    logger.error(f"Error processing year {year}: {year_movies}")
+                    continue
 
-    # Convert to feature matrix
+                total_movies.extend(year_movies)
+                logger.info(f"Found {len(year_movies)} movies from {year}")
+
+    # Shuffle insertion order so the crawl's year/popularity ordering does not
+    # bias the random splits, letting the trees diverge more
+    np.random.default_rng().shuffle(total_movies)
+
+    # Convert to packed feature codes
     logger.info(f"\nConverting {len(total_movies)} movies to feature vectors (genres + popularity + languages)...")
-    matrix, retained = movies_to_matrix(total_movies)
+    codes, retained = movies_to_matrix(total_movies)
 
     # Build index
     logger.info(f"Building {metric} index with {n_trees} trees using {n_jobs} parallel jobs...")
-    index = build_index(matrix, metric=metric, n_trees=n_trees, n_jobs=n_jobs)
+    index = build_index(codes, metric=metric, n_trees=n_trees, n_jobs=n_jobs)
 
     # Save everything
     index_path = output_dir / "movie_index.jakube"
     map_path = output_dir / "movie_id_map.json"
     metadata_path = output_dir / "movie_metadata.json"
+    codes_path = output_dir / "movie_codes.npy"
+    ids_path = output_dir / "movie_ids.npy"
 
     logger.info(f"Saving index to {index_path}...")
     index.save(str(index_path))
@@ -222,15 +330,18 @@ async def build_comprehensive_index(
     tmdb_to_index = {str(movie["id"]): idx for idx, movie in enumerate(retained)}
     index_to_tmdb = {str(idx): movie["id"] for idx, movie in enumerate(retained)}
 
-    with open(map_path, "w") as f:
-        json.dump({
-            "tmdb_to_index": tmdb_to_index,
-            "index_to_tmdb": index_to_tmdb,
-        }, f, indent=2)
+    map_path.write_bytes(orjson.dumps({
+        "tmdb_to_index": tmdb_to_index,
+        "index_to_tmdb": index_to_tmdb,
+    }))
 
     logger.info(f"Saving movie metadata to {metadata_path}...")
-    with open(metadata_path, "w") as f:
-        json.dump(retained, f, indent=2)
+    metadata_path.write_bytes(orjson.dumps(retained))
+
+    # Flat arrays the server memory-maps instead of loading the index and map
+    logger.info(f"Saving feature codes to {codes_path} and TMDB IDs to {ids_path}...")
+    np.save(codes_path, codes)
+    np.save(ids_path, np.array([movie["id"] for movie in retained], dtype=np.int32))
 
     logger.info(f"\nSuccess! Built index with {index.n_items()} movies")
     logger.info(f"Files created:")
@@ -284,8 +395,8 @@ async def main() -> None:
     parser.add_argument(
         "--jobs",
         type=int,
-        default=4,
-        help="Parallel jobs for index building (default: 4)",
+        default=os.cpu_count() or 4,
+        help="Parallel jobs for index building (default: CPU count)",
     )
     
     parser.add_argument(
@@ -294,6 +405,12 @@ async def main() -> None:
         default=".",
         help="Output directory (default: current)",
     )
+    
+    parser.add_argument(
+        "--force-refresh",
+        action="store_true",
+        help="Re-download every page instead of reusing cached pages",
+    )
 
     args = parser.parse_args()
 
@@ -311,7 +428,8 @@ async def main() -> None:
             n_trees=args.trees,
             metric=args.metric,
             n_jobs=args.jobs,
-            output_dir=args.output_dir
+            output_dir=args.output_dir,
+            force_refresh=args.force_refresh
         )
     except KeyboardInterrupt:
         logger.info("\nInterrupted by user")
@@ -322,4 +440,11 @@ async def main() -> None:
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # uvloop's libuv-based event loop schedules the many concurrent page
+    # requests faster; it is not available on Windows
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
@@ -2,13 +2,21 @@ from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
 from pydantic import BaseModel
-from typing import List, Dict, Optional, Union
+from typing import List, Dict, Optional, Tuple, Union
+from functools import lru_cache
+import asyncio
+import heapq
+import logging
 import httpx
+import numpy as np
+import orjson
+from async_lru import alru_cache
 import random
-import json
 import os
 from pathlib import Path
 
+logger = logging.getLogger(__name__)
+
 # Frontend directory path
 FRONTEND_DIR = Path(__file__).parent
 
@@ -67,11 +75,22 @@ ADDITIONAL_DIMENSIONS: int = 5
 # Total dimensions = 19 genres + 1 popularity + 4 languages = 24
 EMBEDDING_DIMENSION = GENRE_DIMENSION + ADDITIONAL_DIMENSIONS  # Now 24
 
+# Jakube's Hamming index stores the binary features packed into int32 words
+# (see movie_vectorizer.movies_to_matrix), so 24 features occupy a single word
+PACKED_DIMENSION = (EMBEDDING_DIMENSION + 31) // 32
+
 # ============================================================================
 INDEX_FILE = BASE_DIR / "movie_index.jakube"
 MAP_FILE = BASE_DIR / "movie_id_map.json"
+METADATA_FILE = BASE_DIR / "movie_metadata.json"
 METRIC = 'hamming'
 
+DEFAULT_LIMIT = 12
+# Neighbor query results memoized per (internal index, k)
+NEIGHBOR_CACHE_SIZE = 10_000
+# Most popular movies whose neighbor queries are primed at startup
+PREWARM_MOVIES = 1000
+
 app = FastAPI()
 
 app.add_middleware(
@@ -84,10 +103,29 @@ app.add_middleware(
 
 JakubeIndexType = Union[AngularIndex, DotProductIndex, EuclideanIndex, ManhattanIndex, HammingIndex]
 
+METRIC_MAP = {
+    'angular': AngularIndex,
+    'euclidean': EuclideanIndex,
+    'manhattan': ManhattanIndex,
+    'dot': DotProductIndex,
+    'dotproduct': DotProductIndex,
+    'hamming': HammingIndex
+}
+
+# METRIC is fixed, so the index class and its dimensionality are resolved once
+IndexClass = METRIC_MAP.get(METRIC.lower(), HammingIndex)
+INDEX_DIMENSION = PACKED_DIMENSION if IndexClass is HammingIndex else EMBEDDING_DIMENSION
+
 jakube_index: JakubeIndexType
-tmdb_to_index: Dict[str, int] = {}
-index_to_tmdb: Dict[str, int] = {}
+tmdb_to_index: Dict[int, int] = {}
+index_to_tmdb: Dict[int, int] = {}
 index_loaded: bool = False
+id_to_meta: Dict[int, Dict] = {}
+# Stored (bit-packed) vector of every indexed movie, extracted once at startup
+vectors_np: Optional[np.ndarray] = None
+
+# Shared TMDB client so every endpoint reuses pooled keep-alive connections
+http_client: Optional[httpx.AsyncClient] = None
 
 # ============================================================================
 # API ENDPOINTS
@@ -96,39 +134,60 @@ index_loaded: bool = False
 @app.get("/api/search")
 async def search_movies(query: str = Query(..., min_length=1)):
     """Search for movies by title"""
-    async with httpx.AsyncClient() as client:
-        url = f"{TMDB_BASE}/search/movie"
-        params = {
-            "api_key": TMDB_API_KEY,
-            "language": "en-US",
-            "query": query,
-            "page": 1
-        }
-        
-        response = await client.get(url, params=params)
-        data = response.json()
-        results = data.get("results", [])[:10]
-        
-        return {"results": results}
+    params = {
+        "api_key": TMDB_API_KEY,
+        "language": "en-US",
+        "query": query,
+        "page": 1
+    }
+    
+    response = await http_client.get("/search/movie", params=params)
+    data = response.json()
+    results = data.get("results", [])[:10]
+    
+    return {"results": results}
 
 
 @app.get("/api/movie/{movie_id}")
 async def get_movie(movie_id: int):
     """Get movie details"""
-    async with httpx.AsyncClient() as client:
-        url = f"{TMDB_BASE}/movie/{movie_id}"
-        params = {
-            "api_key": TMDB_API_KEY,
-            "language": "en-US"
-        }
-        
-        response = await client.get(url, params=params)
-        return response.json()
+    params = {
+        "api_key": TMDB_API_KEY,
+        "language": "en-US"
+    }
+    
+    response = await http_client.get(f"/movie/{movie_id}", params=params)
+    return response.json()
+
+
+@alru_cache(maxsize=50_000, ttl=3600)
+async def _fetch_movie(mid: int) -> Dict:
+    """Fetch TMDB movie details, cached per movie ID for an hour"""
+    params = {"api_key": TMDB_API_KEY, "language": "en-US"}
+    response = await http_client.get(f"/movie/{mid}", params=params)
+    # Raise on non-200 so failed lookups are not cached
+    response.raise_for_status()
+    return response.json()
+
+
+@lru_cache(maxsize=NEIGHBOR_CACHE_SIZE)
+def _query_neighbors(internal_index: int, k: int) -> Tuple[Tuple[int, ...], Tuple[int, ...]]:
+    """Nearest neighbors of an indexed movie, memoized since the index is read-only"""
+    neighbor_indices, distances = jakube_index.get_nns_by_vector(vectors_np[internal_index].tolist(), k)
+    return tuple(neighbor_indices), tuple(distances)
+
+
+async def _get_movie_details(mid: int) -> Dict:
+    """Return the preloaded metadata for an indexed movie, hitting TMDB only on a miss"""
+    movie = id_to_meta.get(mid)
+    if movie is not None:
+        return movie
+    return await _fetch_movie(mid)
 
 
 @app.get("/api/recommend/{movie_id}")
-async def get_recommendations(movie_id: int, limit: int = Query(12, ge=1, le=20)):
-    global jakube_index, tmdb_to_index, index_to_tmdb, index_loaded
+async def get_recommendations(movie_id: int, limit: int = Query(DEFAULT_LIMIT, ge=1, le=20)):
+    global jakube_index, tmdb_to_index, index_to_tmdb, index_loaded, http_client
     
     if not index_loaded:
         raise HTTPException(
@@ -136,129 +195,146 @@ async def get_recommendations(movie_id: int, limit: int = Query(12, ge=1, le=20)
             detail="Jakube recommender index not loaded"
         )
     
-    movie_id_str = str(movie_id)
-    if movie_id_str not in tmdb_to_index:
+    if movie_id not in tmdb_to_index:
         raise HTTPException(
             status_code=404,
             detail="Movie not found in Jakube index"
         )
     
     try:
-        internal_index = tmdb_to_index[movie_id_str]
-        print(f"Internal index for movie {movie_id}: {internal_index}")
+        internal_index = tmdb_to_index[movie_id]
+        logger.debug("Internal index for movie %d: %d", movie_id, internal_index)
         
-        # STEP 1: Get the source movie's details
-        async with httpx.AsyncClient() as client:
-            url = f"{TMDB_BASE}/movie/{movie_id}"
-            params = {"api_key": TMDB_API_KEY, "language": "en-US"}
-            response = await client.get(url, params=params)
-            source_movie = response.json()
-            source_rating = source_movie.get("vote_average", 0)
+        # STEP 1: Get the source movie's details while querying Jakube
+        # The neighbor query always asks for the larger (5x) candidate set so it
+        # can run alongside the TMDB request; it is trimmed in STEP 3 if needed
+        loop = asyncio.get_running_loop()
+        neighbor_task = loop.run_in_executor(
+            None,
+            _query_neighbors,
+            internal_index,
+            limit * 5
+        )
+        
+        source_movie, neighbors = await asyncio.gather(
+            _get_movie_details(movie_id),
+            neighbor_task,
+            return_exceptions=True
+        )
+        
+        if isinstance(neighbors, Exception):
+            logger.error("Error querying Jakube: %s", neighbors)
+            raise neighbors
+        
+        neighbor_indices, distances = neighbors
+        logger.debug("Found %d neighbors", len(neighbor_indices))
+        
+        if isinstance(source_movie, Exception):
+            logger.warning("Error fetching movie %d: %s", movie_id, source_movie)
+            source_movie = {}
+        
+        source_rating = source_movie.get("vote_average", 0)
         
         # STEP 2: Determine if we need rating filtering
         filter_by_rating = source_rating >= 6.0
         
-        # STEP 3: Request MORE neighbors to account for filtering
+        # STEP 3: Keep MORE neighbors to account for filtering
         # Start with 5x to have a better chance of finding enough high-rated movies
         if filter_by_rating:
             search_limit = limit * 5
-            print(f"⚡ Rating filter active (source: {source_rating:.1f}): requesting {search_limit} neighbors")
+            logger.debug("Rating filter active (source: %.1f): requesting %d neighbors", source_rating, search_limit)
         else:
             search_limit = limit + 1
-            print(f"ℹ️  No rating filter: requesting {search_limit} neighbors")
-        
-        try:
-            # Find items with the smallest Hamming distance
-            neighbor_indices, distances = jakube_index.get_nns_by_item(
-                int(internal_index),
-                search_limit
-            )
-            print(f"Found {len(neighbor_indices)} neighbors")
-        except Exception as e:
-            print(f"Error querying Jakube: {str(e)}")
-            raise
+            neighbor_indices = neighbor_indices[:search_limit]
+            logger.debug("No rating filter: requesting %d neighbors", search_limit)
         
         # STEP 4: Convert internal indices to TMDB IDs
         similar_ids = []
         for idx in neighbor_indices:
-            if idx == int(internal_index):
+            if idx == internal_index:
                 continue  # Skip the movie itself
             
-            tmdb_id = index_to_tmdb.get(str(idx))
+            tmdb_id = index_to_tmdb.get(idx)
             if tmdb_id:
-                similar_ids.append(int(tmdb_id))
+                similar_ids.append(tmdb_id)
         
-        print(f"Similar IDs before filtering: {len(similar_ids)} movies")
+        logger.debug("Similar IDs before filtering: %d movies", len(similar_ids))
+        
+        # STEP 5: Look up ALL movie details (preloaded metadata, TMDB for misses)
+        movies = await asyncio.gather(
+            *(_get_movie_details(mid) for mid in similar_ids),
+            return_exceptions=True
+        )
         
-        # STEP 5: Fetch ALL movie details first
         all_candidates = []
-        async with httpx.AsyncClient() as client:
-            for mid in similar_ids:
-                try:
-                    url = f"{TMDB_BASE}/movie/{mid}"
-                    params = {"api_key": TMDB_API_KEY, "language": "en-US"}
-                    response = await client.get(url, params=params)
-                    
-                    if response.status_code == 200:
-                        movie_data = response.json()
-                        all_candidates.append(movie_data)
-                            
-                except Exception as e:
-                    print(f"Error fetching movie {mid}: {str(e)}")
-                    continue
+        for mid, movie_data in zip(similar_ids, movies):
+            if isinstance(movie_data, Exception):
+                logger.warning("Error fetching movie %d: %s", mid, movie_data)
+                continue
+            
+            all_candidates.append(movie_data)
         
-        print(f"Fetched {len(all_candidates)} candidate movies")
+        logger.debug("Fetched %d candidate movies", len(all_candidates))
         
         # STEP 6: Apply intelligent filtering with fallback logic
         recommendations = []
         
         if filter_by_rating:
+            # Ratings and popularity as parallel arrays so the filter and the
+            # fallback sort run in NumPy instead of per-dict Python code
+            n_candidates = len(all_candidates)
+            ratings = np.fromiter(
+                (m.get("vote_average", 0) for m in all_candidates),
+                dtype=np.float64,
+                count=n_candidates
+            )
+            pops = np.fromiter(
+                (m.get("popularity", 0) for m in all_candidates),
+                dtype=np.float64,
+                count=n_candidates
+            )
+            
             # First, try to get movies with rating >= 6.0
-            high_rated = [m for m in all_candidates if m.get("vote_average", 0) >= 6.0]
-            print(f"Found {len(high_rated)} movies with rating >= 6.0")
+            high_mask = ratings >= 6.0
+            high_idx = np.flatnonzero(high_mask)
+            n_high = len(high_idx)
+            logger.debug("Found %d movies with rating >= 6.0", n_high)
             
-            if len(high_rated) >= limit:
+            if n_high >= limit:
                 # We have enough high-rated movies
-                recommendations = high_rated[:limit]
-                print(f"✅ Using {len(recommendations)} high-rated movies (rating >= 6.0)")
+                recommendations = [all_candidates[i] for i in high_idx[:limit]]
+                logger.debug("Using %d high-rated movies (rating >= 6.0)", len(recommendations))
                 
             else:
                 # Not enough high-rated movies, so we'll use fallback strategy
-                print(f"⚠️  Only {len(high_rated)} high-rated movies found (need {limit})")
-                print(f"📊 Applying fallback: sorting remaining by popularity")
+                logger.debug("Only %d high-rated movies found (need %d), sorting remaining by popularity", n_high, limit)
                 
                 # Take all high-rated movies first
-                recommendations = high_rated.copy()
+                recommendations = [all_candidates[i] for i in high_idx]
                 
-                # Get remaining movies (rating < 6.0) and sort by popularity
-                remaining = [m for m in all_candidates if m.get("vote_average", 0) < 6.0]
-                
-                # Sort by vote_average first, then by popularity as tiebreaker
-                remaining_sorted = sorted(
-                    remaining,
-                    key=lambda m: (m.get("vote_average", 0), m.get("popularity", 0)),
-                    reverse=True
-                )
+                # Get remaining movies (rating < 6.0) and sort by
+                # vote_average first, then by popularity as tiebreaker
+                low_idx = np.flatnonzero(~high_mask)
+                order = np.lexsort((-pops[low_idx], -ratings[low_idx]))
                 
                 # Fill up to limit with the best remaining movies
                 needed = limit - len(recommendations)
-                recommendations.extend(remaining_sorted[:needed])
+                recommendations.extend(all_candidates[i] for i in low_idx[order[:needed]])
                 
-                print(f"✅ Final mix: {len(high_rated)} high-rated + {len(recommendations) - len(high_rated)} best remaining")
+                logger.debug("Final mix: %d high-rated + %d best remaining", n_high, len(recommendations) - n_high)
                 
-                # Log the rating breakdown
-                for i, movie in enumerate(recommendations):
-                    rating = movie.get("vote_average", 0)
-                    popularity = movie.get("popularity", 0)
-                    title = movie.get("title", "Unknown")
-                    if rating >= 6.0:
-                        print(f"  {i+1}. ✓ {title} (⭐{rating:.1f}, 🔥{popularity:.0f})")
-                    else:
-                        print(f"  {i+1}. ↓ {title} (⭐{rating:.1f}, 🔥{popularity:.0f})")
+                # Log the rating breakdown (formatting N lines is skipped unless debugging)
+                if logger.isEnabledFor(logging.DEBUG):
+                    for i, movie in enumerate(recommendations):
+                        rating = movie.get("vote_average", 0)
+                        popularity = movie.get("popularity", 0)
+                        title = movie.get("title", "Unknown")
+                        marker = "✓" if rating >= 6.0 else "↓"
+                        logger.debug("  %d. %s %s (⭐%.1f, 🔥%.0f)", i + 1, marker, title, rating, popularity)
         else:
             # No rating filter, just return top matches
             recommendations = all_candidates[:limit]
-            print(f"✅ Returning {len(recommendations)} recommendations (no filter)")
+            logger.debug("Returning %d recommendations (no filter)", len(recommendations))
         
         return {
             "results": recommendations,
@@ -295,22 +371,19 @@ async def serve_js():
 
 @app.on_event("startup")
 async def startup_event():
-    global jakube_index, tmdb_to_index, index_to_tmdb, index_loaded
+    global jakube_index, tmdb_to_index, index_to_tmdb, index_loaded, id_to_meta, vectors_np, http_client
     
     print("\nInitializing Enhanced Jakube Movie Recommender (Genre + Popularity + Language)...")
     
-    # Initialize the correct index type
-    METRIC_MAP = {
-        'angular': AngularIndex,
-        'euclidean': EuclideanIndex,
-        'manhattan': ManhattanIndex,
-        'dot': DotProductIndex,
-        'dotproduct': DotProductIndex,
-        'hamming': HammingIndex
-    }
+    http_client = httpx.AsyncClient(
+        base_url=TMDB_BASE,
+        timeout=10.0,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=200)
+    )
     
-    IndexClass = METRIC_MAP.get(METRIC.lower(), HammingIndex)
-    jakube_index = IndexClass(EMBEDDING_DIMENSION)  # Uses 24 dimensions
+    # Initialize the correct index type
+    jakube_index = IndexClass(INDEX_DIMENSION)  # 24 features, bit-packed for Hamming
     
     if not INDEX_FILE.exists() or not MAP_FILE.exists():
         print(f"Error: Required files not found:")
@@ -328,14 +401,41 @@ async def startup_event():
         n_trees = jakube_index.n_trees()
         print(f"✓ Index loaded: {n_items} items across {n_trees} trees")
         
+        # Query by precomputed vector instead of making Jakube look the item up
+        vectors_np = np.array(
+            [jakube_index.get_item(i) for i in range(n_items)],
+            dtype=np.int32
+        ).reshape(n_items, INDEX_DIMENSION)
+        print(f"✓ Extracted {len(vectors_np)} stored vectors")
+        
         print(f"\nLoading movie ID mappings from {MAP_FILE}...")
-        with open(MAP_FILE, 'r') as f:
-            maps = json.load(f)
-            tmdb_to_index = maps['tmdb_to_index']
-            index_to_tmdb = maps['index_to_tmdb']
+        maps = orjson.loads(MAP_FILE.read_bytes())
+        # Integer keys and values so the recommendation hot path needs no
+        # str()/int() conversions per lookup
+        tmdb_to_index = {int(k): int(v) for k, v in maps['tmdb_to_index'].items()}
+        index_to_tmdb = {int(k): int(v) for k, v in maps['index_to_tmdb'].items()}
         
         print(f"✓ Mappings loaded: {len(tmdb_to_index)} movies indexed")
         
+        if METADATA_FILE.exists():
+            print(f"\nLoading movie metadata from {METADATA_FILE}...")
+            id_to_meta = {movie["id"]: movie for movie in orjson.loads(METADATA_FILE.read_bytes())}
+            print(f"✓ Metadata loaded: {len(id_to_meta)} movies")
+        else:
+            print(f"Metadata file {METADATA_FILE} not found, movie details will be fetched from TMDB")
+        
+        # Prime the neighbor cache for the most popular movies with the
+        # default request size, since they receive most of the traffic
+        popular = heapq.nlargest(
+            PREWARM_MOVIES,
+            (m for m in id_to_meta.values() if m["id"] in tmdb_to_index),
+            key=lambda m: m.get("popularity", 0)
+        )
+        for movie in popular:
+            _query_neighbors(tmdb_to_index[movie["id"]], DEFAULT_LIMIT * 5)
+        if popular:
+            print(f"✓ Neighbor cache primed for {len(popular)} popular movies")
+        
         index_loaded = True
         
         print("\nEnhanced Jakube Recommender loaded successfully! 🎬")
@@ -356,6 +456,15 @@ async def startup_event():
         index_loaded = False
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    global http_client
+    
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+
 @app.get("/health")
 async def health():
     global index_loaded
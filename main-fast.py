@@ -67,6 +67,10 @@ ADDITIONAL_DIMENSIONS: int = 5
 # Total dimensions = 19 genres + 1 popularity + 4 languages = 24
 EMBEDDING_DIMENSION = GENRE_DIMENSION + ADDITIONAL_DIMENSIONS  # Now 24
 
+# Jakube's Hamming index stores the binary features packed into int32 words
+# (see movie_vectorizer.movies_to_matrix), so 24 features occupy a single word
+PACKED_DIMENSION = (EMBEDDING_DIMENSION + 31) // 32
+
 # ============================================================================
 INDEX_FILE = BASE_DIR / "movie_index.jakube"
 MAP_FILE = BASE_DIR / "movie_id_map.json"
@@ -84,6 +88,19 @@ app.add_middleware(
 
 JakubeIndexType = Union[AngularIndex, DotProductIndex, EuclideanIndex, ManhattanIndex, HammingIndex]
 
+METRIC_MAP = {
+    'angular': AngularIndex,
+    'euclidean': EuclideanIndex,
+    'manhattan': ManhattanIndex,
+    'dot': DotProductIndex,
+    'dotproduct': DotProductIndex,
+    'hamming': HammingIndex
+}
+
+# METRIC is fixed, so the index class and its dimensionality are resolved once
+IndexClass = METRIC_MAP.get(METRIC.lower(), HammingIndex)
+INDEX_DIMENSION = PACKED_DIMENSION if IndexClass is HammingIndex else EMBEDDING_DIMENSION
+
 jakube_index: JakubeIndexType
 tmdb_to_index: Dict[str, int] = {}
 index_to_tmdb: Dict[str, int] = {}
@@ -227,17 +244,7 @@ async def startup_event():
     print("\nInitializing Enhanced Jakube Movie Recommender (Genre + Popularity + Language)...")
     
     # Initialize the correct index type
-    METRIC_MAP = {
-        'angular': AngularIndex,
-        'euclidean': EuclideanIndex,
-        'manhattan': ManhattanIndex,
-        'dot': DotProductIndex,
-        'dotproduct': DotProductIndex,
-        'hamming': HammingIndex
-    }
-    
-    IndexClass = METRIC_MAP.get(METRIC.lower(), HammingIndex)
-    jakube_index = IndexClass(EMBEDDING_DIMENSION)  # Uses 24 dimensions
+    jakube_index = IndexClass(INDEX_DIMENSION)  # 24 features, bit-packed for Hamming
     
     if not INDEX_FILE.exists() or not MAP_FILE.exists():
         print(f"Error: Required files not found:")
@@ -1,25 +1,34 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import ORJSONResponse, Response
 from pydantic import BaseModel
-from typing import List, Dict, Optional, Union
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List, Dict, Optional, Tuple
+from async_lru import alru_cache
+import asyncio
+import hashlib
 import httpx
+import logging
+import numpy as np
+import orjson
 import random
-import json
 import os
+import time
 from pathlib import Path
 
+logger = logging.getLogger(__name__)
+
+try:
+    # Compiled XOR + popcount over the packed codes, when the local Jakube
+    # build provides it; otherwise the scan falls back to NumPy
+    from jakube import hamming_scan
+except ImportError:
+    hamming_scan = None
+
 # Frontend directory path
 FRONTEND_DIR = Path(__file__).parent
 
-from jakube import (
-    AngularIndex,
-    DotProductIndex,
-    EuclideanIndex,
-    ManhattanIndex,
-    HammingIndex
-)
-
 # ============================================================================
 # CONFIGURATION
 # ============================================================================
@@ -68,11 +77,41 @@ ADDITIONAL_DIMENSIONS: int = 5
 EMBEDDING_DIMENSION = GENRE_DIMENSION + ADDITIONAL_DIMENSIONS  # Now 24
 
 # ============================================================================
-INDEX_FILE = BASE_DIR / "movie_index.jakube"
-MAP_FILE = BASE_DIR / "movie_id_map.json"
-METRIC = 'hamming'
+# Flat arrays written by enhanced_index_builder.py, memory-mapped at startup:
+# one packed uint32 feature code (see movie_vectorizer.movies_to_matrix) and
+# one TMDB ID per indexed movie, in the same order
+CODES_FILE = BASE_DIR / "movie_codes.npy"
+IDS_FILE = BASE_DIR / "movie_ids.npy"
+
+# TMDB movie details barely change, so keep recent ones in memory for an hour
+MOVIE_CACHE_SIZE = 4096
+MOVIE_CACHE_TTL = 3600
+
+# Upper bounds on TMDB detail lookups across all requests, so a slow TMDB
+# degrades into partial results instead of hung requests
+TMDB_FANOUT_LIMIT = 8
+TMDB_FETCH_TIMEOUT = httpx.Timeout(3.0, connect=1.0)
+# Deadline for a whole lookup, waiting for a semaphore slot included, so a
+# hung TMDB costs each request a fixed amount of time however busy we are
+TMDB_LOOKUP_DEADLINE = 3.0
+
+# The UI searches on every keystroke, so recent queries are cached briefly
+SEARCH_CACHE_SIZE = 1024
+SEARCH_CACHE_TTL = 300
+SEARCH_RESULT_LIMIT = 10
+# The only search result fields the frontend renders
+SEARCH_FIELDS = ("id", "title", "poster_path", "release_date", "vote_average")
 
-app = FastAPI()
+# Movies sharing a feature code share a neighbor list, and only a few
+# thousand distinct codes occur, so neighbor lists are memoized per code
+NEIGHBOR_CACHE_SIZE = 10_000
+
+# Movie details and recommendations are stable for a given ID, so clients
+# may reuse them for an hour and revalidate with If-None-Match
+API_CACHE_CONTROL = "public, max-age=3600"
+
+# orjson serializes the movie payloads several times faster than stdlib json
+app = FastAPI(default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -82,12 +121,34 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-JakubeIndexType = Union[AngularIndex, DotProductIndex, EuclideanIndex, ManhattanIndex, HammingIndex]
-
-jakube_index: JakubeIndexType
-tmdb_to_index: Dict[str, int] = {}
-index_to_tmdb: Dict[str, int] = {}
+# Integer-keyed so lookups need no str() conversion or string hashing
+tmdb_to_index: Dict[int, int] = {}
+# Dense internal index -> TMDB ID table
+index_to_tmdb: Optional[np.ndarray] = None
 index_loaded: bool = False
+# Changes whenever the codes file is rebuilt; part of the recommendation ETag
+index_version: str = ""
+# Packed 24-bit feature code of every indexed movie, scanned directly for
+# recommendations since a full XOR + popcount pass beats a tree lookup here
+codes: Optional[np.ndarray] = None
+
+# Frontend files read once at startup: filename -> (content, media type)
+static_files: Dict[str, Tuple[bytes, str]] = {}
+STATIC_MEDIA_TYPES = {
+    "index.html": "text/html",
+    "style.css": "text/css",
+    "app.js": "application/javascript",
+}
+STATIC_CACHE_CONTROL = "public, max-age=300"
+
+# Shared TMDB client, created on startup so every endpoint reuses pooled
+# HTTP/2 connections instead of paying a fresh handshake per request
+http_client: Optional[httpx.AsyncClient] = None
+# Caps concurrent TMDB detail requests process-wide; cache hits skip it
+tmdb_semaphore = asyncio.Semaphore(TMDB_FANOUT_LIMIT)
+
+# Normalized query -> (expiry time, trimmed results), oldest first
+_SEARCH_CACHE: "OrderedDict[str, Tuple[float, List[Dict]]]" = OrderedDict()
 
 # ============================================================================
 # API ENDPOINTS
@@ -96,39 +157,114 @@ index_loaded: bool = False
 @app.get("/api/search")
 async def search_movies(query: str = Query(..., min_length=1)):
     """Search for movies by title"""
-    async with httpx.AsyncClient() as client:
-        url = f"{TMDB_BASE}/search/movie"
-        params = {
-            "api_key": TMDB_API_KEY,
-            "language": "en-US",
-            "query": query,
-            "page": 1
-        }
-        
-        response = await client.get(url, params=params)
-        data = response.json()
-        results = data.get("results", [])[:10]
-        
-        return {"results": results}
+    key = query.lower().strip()
+    now = time.monotonic()
+    
+    cached = _SEARCH_CACHE.get(key)
+    if cached is not None and cached[0] > now:
+        _SEARCH_CACHE.move_to_end(key)
+        return {"results": cached[1]}
+    
+    params = {
+        "api_key": TMDB_API_KEY,
+        "language": "en-US",
+        "query": query,
+        "page": 1
+    }
+    
+    response = await http_client.get("/search/movie", params=params)
+    data = response.json()
+    results = [
+        {field: movie[field] for field in SEARCH_FIELDS if field in movie}
+        for movie in data.get("results", [])[:SEARCH_RESULT_LIMIT]
+    ]
+    
+    # Only cache successful lookups so TMDB errors are retried next time
+    if response.status_code == 200:
+        _SEARCH_CACHE[key] = (now + SEARCH_CACHE_TTL, results)
+        _SEARCH_CACHE.move_to_end(key)
+        if len(_SEARCH_CACHE) > SEARCH_CACHE_SIZE:
+            _SEARCH_CACHE.popitem(last=False)
+    
+    return {"results": results}
+
+
+@alru_cache(maxsize=MOVIE_CACHE_SIZE, ttl=MOVIE_CACHE_TTL)
+async def _fetch_movie(mid: int) -> Dict:
+    """Fetch TMDB movie details, cached per movie ID"""
+    params = {"api_key": TMDB_API_KEY, "language": "en-US"}
+    async with asyncio.timeout(TMDB_LOOKUP_DEADLINE):
+        async with tmdb_semaphore:
+            response = await http_client.get(f"/movie/{mid}", params=params, timeout=TMDB_FETCH_TIMEOUT)
+    # Raise on non-200 so failed lookups are not cached
+    response.raise_for_status()
+    return response.json()
+
+
+def _not_modified(request: Request, etag: str) -> Optional[Response]:
+    """Return a 304 response if the client already holds this ETag"""
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": API_CACHE_CONTROL})
+    return None
 
 
 @app.get("/api/movie/{movie_id}")
-async def get_movie(movie_id: int):
+async def get_movie(movie_id: int, request: Request):
     """Get movie details"""
-    async with httpx.AsyncClient() as client:
-        url = f"{TMDB_BASE}/movie/{movie_id}"
-        params = {
-            "api_key": TMDB_API_KEY,
-            "language": "en-US"
-        }
-        
-        response = await client.get(url, params=params)
-        return response.json()
+    try:
+        movie = await _fetch_movie(movie_id)
+    except httpx.HTTPStatusError as e:
+        # Only a missing movie is the client's problem; any other TMDB status
+        # (bad API key, rate limiting, outages) is an upstream failure
+        if e.response.status_code == 404:
+            raise HTTPException(status_code=404, detail=f"Movie {movie_id} not found")
+        raise HTTPException(
+            status_code=502,
+            detail=f"TMDB lookup failed for movie {movie_id}"
+        )
+    except (httpx.RequestError, TimeoutError):
+        # Timeouts (including the lookup deadline) and connection failures
+        raise HTTPException(
+            status_code=504,
+            detail=f"TMDB did not respond for movie {movie_id}"
+        )
+    
+    # Hash the serialized body so the ETag changes when TMDB's data does
+    body = orjson.dumps(movie)
+    etag = f'"{hashlib.md5(body).hexdigest()}"'
+    not_modified = _not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+    
+    return Response(
+        body,
+        media_type="application/json",
+        headers={"ETag": etag, "Cache-Control": API_CACHE_CONTROL}
+    )
+
+
+@lru_cache(maxsize=NEIGHBOR_CACHE_SIZE)
+def _nearest_codes(code: int, k: int) -> Tuple[Tuple[int, ...], Tuple[int, ...]]:
+    """Brute-force the k indexed movies closest in Hamming distance to a feature code"""
+    if hamming_scan is not None:
+        distances = hamming_scan(codes, code)
+    else:
+        x = codes ^ np.uint32(code)
+        distances = np.unpackbits(x.view(np.uint8), bitorder='little').reshape(-1, 32).sum(axis=1)
+    
+    # Distances only take 33 values, so a counting sort beats a comparison
+    # sort: find the smallest distance whose running count reaches k, then
+    # keep everything up to it in (distance, index) order
+    running = np.cumsum(np.bincount(distances, minlength=33))
+    cutoff = int(np.searchsorted(running, min(k, len(distances))))
+    candidates = np.flatnonzero(distances <= cutoff)
+    nearest = candidates[np.argsort(distances[candidates], kind='stable')][:k]
+    return tuple(nearest.tolist()), tuple(distances[nearest].tolist())
 
 
 @app.get("/api/recommend/{movie_id}")
-async def get_recommendations(movie_id: int, limit: int = Query(12, ge=1, le=20)):
-    global jakube_index, tmdb_to_index, index_to_tmdb, index_loaded
+async def get_recommendations(movie_id: int, request: Request, limit: int = Query(12, ge=1, le=20)):
+    global codes, tmdb_to_index, index_to_tmdb, index_loaded, index_version, http_client
     
     if not index_loaded:
         raise HTTPException(
@@ -136,67 +272,74 @@ async def get_recommendations(movie_id: int, limit: int = Query(12, ge=1, le=20)
             detail="Jakube recommender index not loaded"
         )
     
-    movie_id_str = str(movie_id)
-    if movie_id_str not in tmdb_to_index:
+    internal_index = tmdb_to_index.get(movie_id)
+    if internal_index is None:
         raise HTTPException(
             status_code=404,
             detail="Movie not found in Jakube index"
         )
     
+    # Neighbors only change when the index is rebuilt
+    etag = f'"{movie_id}-{limit}-{index_version}"'
+    not_modified = _not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+    
     try:
-        internal_index = tmdb_to_index[movie_id_str]
-        print(f"Internal index for movie {movie_id}: {internal_index}")
+        logger.debug("Internal index for movie %d: %d", movie_id, internal_index)
         
         try:
             # Find items with the smallest Hamming distance
-            # (most similar in genre, popularity, and language)
-            neighbor_indices, distances = jakube_index.get_nns_by_item(
-                int(internal_index),
+            # (most similar in genre, popularity, and language).
+            # A cache miss scans every code, so keep it off the event loop
+            loop = asyncio.get_running_loop()
+            neighbor_indices, distances = await loop.run_in_executor(
+                None,
+                _nearest_codes,
+                int(codes[internal_index]),
                 limit + 1  # +1 to account for the movie itself
             )
             
-            print(f"Found neighbors: {neighbor_indices}, distances: {distances}")
+            logger.debug("Found neighbors: %s, distances: %s", neighbor_indices, distances)
         
         except Exception as e:
-            print(f"Error querying Jakube: {str(e)}")
+            logger.error("Error scanning feature codes: %s", e)
             raise
         
-        similar_ids = []
-        for idx in neighbor_indices:
-            if idx == int(internal_index):
-                continue  # Skip the movie itself
-            
-            tmdb_id = index_to_tmdb.get(str(idx))
-            print(f"Converting index {idx} to TMDB ID: {tmdb_id}")
-            
-            if tmdb_id:
-                similar_ids.append(int(tmdb_id))
-            
-            if len(similar_ids) == limit:
-                break
+        # Skip the movie itself, then map the rest to TMDB IDs in one gather
+        similar_indices = [idx for idx in neighbor_indices if idx != internal_index][:limit]
+        similar_ids = index_to_tmdb[similar_indices].tolist()
         
-        print(f"Final similar IDs: {similar_ids}")
+        logger.debug("Final similar IDs: %s", similar_ids)
+        
+        # Fetch all movie details concurrently, keeping neighbor order; a
+        # failed or timed-out lookup is dropped rather than failing the request
+        movies = await asyncio.gather(
+            *(_fetch_movie(mid) for mid in similar_ids),
+            return_exceptions=True
+        )
         
         recommendations = []
-        async with httpx.AsyncClient() as client:
-            for mid in similar_ids:
-                try:
-                    url = f"{TMDB_BASE}/movie/{mid}"
-                    params = {"api_key": TMDB_API_KEY, "language": "en-US"}
-                    response = await client.get(url, params=params)
-                    
-                    if response.status_code == 200:
-                        recommendations.append(response.json())
-                
-                except Exception as e:
-                    print(f"Error fetching movie {mid}: {str(e)}")
-                    continue
+        for mid, movie in zip(similar_ids, movies):
+            if isinstance(movie, Exception):
+                logger.warning("Error fetching movie %d: %s", mid, movie)
+                continue
+            
+            recommendations.append(movie)
         
-        return {
+        payload = {
             "results": recommendations,
             "algorithm": "jakube_enhanced_hamming_genre_popularity_language",
-            "source_movie_id": movie_id
+            "source_movie_id": movie_id,
+            # Share of neighbors whose details were fetched successfully
+            "completion": len(recommendations) / len(similar_ids) if similar_ids else 1.0
         }
+        
+        # Don't let clients hold on to a list with failed lookups missing
+        if len(recommendations) < len(similar_ids):
+            return payload
+        
+        return ORJSONResponse(payload, headers={"ETag": etag, "Cache-Control": API_CACHE_CONTROL})
     
     except Exception as e:
         raise HTTPException(
@@ -205,61 +348,75 @@ async def get_recommendations(movie_id: int, limit: int = Query(12, ge=1, le=20)
         )
 
 
+def _static_response(name: str) -> Response:
+    """Serve a preloaded frontend file without touching the filesystem"""
+    if name not in static_files:
+        raise HTTPException(status_code=404, detail=f"{name} not found")
+    content, media_type = static_files[name]
+    return Response(content, media_type=media_type, headers={"Cache-Control": STATIC_CACHE_CONTROL})
+
+
 @app.get("/")
 async def serve_homepage():
-    return FileResponse(FRONTEND_DIR / "index.html")
+    return _static_response("index.html")
 
 
 @app.get("/style.css")
 async def serve_css():
-    return FileResponse(FRONTEND_DIR / "style.css")
+    return _static_response("style.css")
 
 
 @app.get("/app.js")
 async def serve_js():
-    return FileResponse(FRONTEND_DIR / "app.js")
+    return _static_response("app.js")
 
 
 @app.on_event("startup")
 async def startup_event():
-    global jakube_index, tmdb_to_index, index_to_tmdb, index_loaded
+    global codes, tmdb_to_index, index_to_tmdb, index_loaded, index_version, http_client
     
     print("\nInitializing Enhanced Jakube Movie Recommender (Genre + Popularity + Language)...")
     
-    # Initialize the correct index type
-    METRIC_MAP = {
-        'angular': AngularIndex,
-        'euclidean': EuclideanIndex,
-        'manhattan': ManhattanIndex,
-        'dot': DotProductIndex,
-        'dotproduct': DotProductIndex,
-        'hamming': HammingIndex
-    }
+    http_client = httpx.AsyncClient(
+        base_url=TMDB_BASE,
+        http2=True,
+        timeout=5.0,
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100)
+    )
     
-    IndexClass = METRIC_MAP.get(METRIC.lower(), HammingIndex)
-    jakube_index = IndexClass(EMBEDDING_DIMENSION)  # Uses 24 dimensions
+    for name, media_type in STATIC_MEDIA_TYPES.items():
+        path = FRONTEND_DIR / name
+        if path.exists():
+            static_files[name] = (path.read_bytes(), media_type)
     
-    if not INDEX_FILE.exists() or not MAP_FILE.exists():
+    if not CODES_FILE.exists() or not IDS_FILE.exists():
         print(f"Error: Required files not found:")
-        print(f"  - Index file: {INDEX_FILE} ({'exists' if INDEX_FILE.exists() else 'missing'})")
-        print(f"  - Map file: {MAP_FILE} ({'exists' if MAP_FILE.exists() else 'missing'})")
+        print(f"  - Codes file: {CODES_FILE} ({'exists' if CODES_FILE.exists() else 'missing'})")
+        print(f"  - IDs file: {IDS_FILE} ({'exists' if IDS_FILE.exists() else 'missing'})")
         print("\nPlease run enhanced_index_builder.py first:")
         print("  python enhanced_index_builder.py --metric hamming --trees 20")
         return
     
     try:
-        print(f"\nLoading Jakube index from {INDEX_FILE}...")
-        jakube_index.load(str(INDEX_FILE))
+        # Memory-mapped so startup is just an open(); pages load on first scan
+        # and are shared between worker processes
+        print(f"\nLoading feature codes from {CODES_FILE}...")
+        codes = np.load(CODES_FILE, mmap_mode='r')
+        index_version = str(CODES_FILE.stat().st_mtime_ns)
+        n_items = len(codes)
+        print(f"âœ“ Codes loaded: {n_items} movies")
+        
+        print(f"\nLoading movie IDs from {IDS_FILE}...")
+        index_to_tmdb = np.load(IDS_FILE, mmap_mode='r')
         
-        n_items = jakube_index.n_items()
-        n_trees = jakube_index.n_trees()
-        print(f"âœ“ Index loaded: {n_items} items across {n_trees} trees")
+        # Both files must come from the same build, row for row
+        if len(index_to_tmdb) != n_items:
+            print(f"Error: {IDS_FILE} has {len(index_to_tmdb)} IDs but {CODES_FILE} has {n_items} codes")
+            print("\nPlease re-run enhanced_index_builder.py to regenerate both files")
+            index_loaded = False
+            return
         
-        print(f"\nLoading movie ID mappings from {MAP_FILE}...")
-        with open(MAP_FILE, 'r') as f:
-            maps = json.load(f)
-            tmdb_to_index = maps['tmdb_to_index']
-            index_to_tmdb = maps['index_to_tmdb']
+        tmdb_to_index = {tmdb_id: idx for idx, tmdb_id in enumerate(index_to_tmdb.tolist())}
         
         print(f"âœ“ Mappings loaded: {len(tmdb_to_index)} movies indexed")
         
@@ -276,13 +433,28 @@ async def startup_event():
         index_loaded = False
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    global http_client
+    
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+
 @app.get("/health")
 async def health():
     global index_loaded
+    cache_info = _fetch_movie.cache_info()
     return {
         "status": "healthy",
         "algorithm": "jakube_enhanced_hamming_genre_popularity_language",
-        "index_loaded": index_loaded
+        "index_loaded": index_loaded,
+        "movie_cache": {
+            "hits": cache_info.hits,
+            "misses": cache_info.misses,
+            "size": cache_info.currsize
+        }
     }
 
 
@@ -36,112 +36,116 @@ GENRE_LIST = [
 # Create a mapping from genre ID -> vector index
 GENRE_ID_TO_INDEX: Dict[int, int] = {genre['id']: i for i, genre in enumerate(GENRE_LIST)}
 GENRE_DIMENSION: int = len(GENRE_LIST)  # Should be 19
+GENRE_IDS: np.ndarray = np.array([genre['id'] for genre in GENRE_LIST], dtype=np.int64)
 
 # Additional feature dimensions
 # is_popular (1 dimension), is_tamil, is_malayalam, is_hindi, is_english (4 dimensions)
 ADDITIONAL_DIMENSIONS: int = 5
 
+# Original languages for the language dimensions, in vector order
+LANGUAGE_CODES: np.ndarray = np.array(["ta", "ml", "hi", "en"])
+
 # Total dimensions = 19 genres + 1 popularity + 4 languages = 24
 TOTAL_DIMENSION: int = GENRE_DIMENSION + ADDITIONAL_DIMENSIONS
 
+# Jakube's Hamming metric XORs and popcounts whole int32 words, so the
+# binary features are packed 32 to a word (24 bits -> a single word)
+PACKED_DIMENSION: int = (TOTAL_DIMENSION + 31) // 32
+
+# Bit weight of each feature within a movie's packed code
+FEATURE_BITS: np.ndarray = np.left_shift(np.uint32(1), np.arange(TOTAL_DIMENSION, dtype=np.uint32))
+
+# Genre ID -> feature bit lookup table (0 for IDs that are not a known genre),
+# so encoding a genre is a single array index instead of a search
+MAX_GENRE_ID: int = int(GENRE_IDS.max())
+GENRE_BIT_LUT: np.ndarray = np.zeros(MAX_GENRE_ID + 1, dtype=np.uint32)
+GENRE_BIT_LUT[GENRE_IDS] = FEATURE_BITS[:GENRE_DIMENSION]
+
 # ============================================================================
 
 def movies_to_matrix(items: Iterable[Dict]) -> Tuple[np.ndarray, List[Dict]]:
     """
-    Convert TMDB movie documents to a multi-hot encoded feature matrix
-    for use with Hamming distance.
+    Convert TMDB movie documents to packed binary feature codes for use
+    with Hamming distance. Each movie becomes a single uint32 whose bit i
+    is feature i, so the distance between two movies is popcount(a ^ b).
     
-    Feature vector structure:
-    - First 19 dimensions: Genre (multi-hot encoding)
-    - Dimension 20: is_popular (1 if vote_average >= 8.0, else 0)
-    - Dimension 21: is_tamil (1 if original_language == 'ta', else 0)
-    - Dimension 22: is_malayalam (1 if original_language == 'ml', else 0)
-    - Dimension 23: is_hindi (1 if original_language == 'hi', else 0)
-    - Dimension 24: is_english (1 if original_language == 'en', else 0)
+    Feature bit layout:
+    - Bits 0-18: Genre (multi-hot encoding)
+    - Bit 19: is_popular (1 if vote_average >= 8.0, else 0)
+    - Bit 20: is_tamil (1 if original_language == 'ta', else 0)
+    - Bit 21: is_malayalam (1 if original_language == 'ml', else 0)
+    - Bit 22: is_hindi (1 if original_language == 'hi', else 0)
+    - Bit 23: is_english (1 if original_language == 'en', else 0)
     """
     all_items = list(items)
     if not all_items:
         raise RuntimeError("No TMDB items to process.")
 
-    # Use a list to build vectors first
-    vectors = []
-    retained_items = []
-
-    for movie in all_items:
-        # Create a zero-vector for this movie
-        # We use np.int32 because jakube/annoy Hamming distance works on integers
-        vector = np.zeros(TOTAL_DIMENSION, dtype=np.int32)
-
-        # ========================================
-        # STEP 1: Process genre information
-        # ========================================
-        genre_ids = movie.get("genre_ids")
-        
-        # Only process movies that have genre information
-        if not genre_ids:
-            continue
-
-        found_genres = 0
-        for gid in genre_ids:
-            # Find the index for this genre ID
-            idx = GENRE_ID_TO_INDEX.get(gid)
-            if idx is not None:
-                # Set the '1' in our multi-hot vector
-                vector[idx] = 1
-                found_genres += 1
-
-        # Only include movies that have at least one known genre
-        if found_genres == 0:
-            continue
-
-        # ========================================
-        # STEP 2: Process popularity feature
-        # ========================================
-        # is_popular: 1 if vote_average >= 8.0, else 0
-        vote_average = movie.get("vote_average", 0)
-        if vote_average >= 8.0:
-            vector[GENRE_DIMENSION] = 1  # Index 19
-        else:
-            vector[GENRE_DIMENSION] = 0
-
-        # ========================================
-        # STEP 3: Process language features
-        # ========================================
-        original_language = movie.get("original_language", "")
-        
-        # is_tamil (index 20)
-        if original_language == "ta":
-            vector[GENRE_DIMENSION + 1] = 1
-        
-        # is_malayalam (index 21)
-        if original_language == "ml":
-            vector[GENRE_DIMENSION + 2] = 1
-        
-        # is_hindi (index 22)
-        if original_language == "hi":
-            vector[GENRE_DIMENSION + 3] = 1
-        
-        # is_english (index 23)
-        if original_language == "en":
-            vector[GENRE_DIMENSION + 4] = 1
-
-        # ========================================
-        # Add to results
-        # ========================================
-        vectors.append(vector)
-        retained_items.append(movie)
-
-    if not vectors:
+    n_items = len(all_items)
+
+    # ========================================
+    # STEP 1: Gather feature fields as columns
+    # ========================================
+    # A DataFrame pulls the needed fields out of every dict in one C-level
+    # pass; missing keys come through as NaN
+    df = pd.DataFrame.from_records(all_items, columns=["genre_ids", "vote_average", "original_language"])
+    vote_average = df["vote_average"].fillna(0).to_numpy(dtype=np.float64)
+    original_language = df["original_language"].fillna("").to_numpy(dtype=str)
+
+    # ========================================
+    # STEP 2: Process genre information
+    # ========================================
+    # Explode the ragged genre lists into CSR form: a flat array of genre IDs
+    # plus the offset where each movie's run starts. Empty or missing lists
+    # explode to a single NaN, so every movie owns a non-empty run.
+    exploded = df["genre_ids"].explode()
+    flat_genres = exploded.fillna(-1).to_numpy(dtype=np.int64)
+    row_of = exploded.index.to_numpy()
+    indptr = np.flatnonzero(np.diff(row_of, prepend=-1))
+
+    # Genre ID -> feature bit via the lookup table, then OR each movie's run.
+    # Out-of-range IDs, including the -1 placeholder, read the empty slot 0.
+    in_range = (flat_genres > 0) & (flat_genres <= MAX_GENRE_ID)
+    genre_bits = GENRE_BIT_LUT[np.where(in_range, flat_genres, 0)]
+
+    # Every later feature is OR-ed into this one preallocated buffer in place
+    codes = np.empty(n_items, dtype=np.uint32)
+    np.bitwise_or.reduceat(genre_bits, indptr, out=codes)
+
+    # Only include movies that have at least one known genre
+    keep = codes != 0
+    if not keep.any():
         raise RuntimeError("No TMDB items contained usable genre features.")
 
-    # Create the final feature matrix
-    matrix = np.array(vectors, dtype=np.int32)
-    
-    return matrix, retained_items
+    # ========================================
+    # STEP 3: Process popularity feature
+    # ========================================
+    # is_popular (bit 19): 1 if vote_average >= 8.0, else 0
+    np.bitwise_or(codes, FEATURE_BITS[GENRE_DIMENSION], out=codes, where=vote_average >= 8.0)
+
+    # ========================================
+    # STEP 4: Process language features
+    # ========================================
+    # is_tamil, is_malayalam, is_hindi, is_english (bits 20-23)
+    for language, bit in zip(LANGUAGE_CODES, FEATURE_BITS[GENRE_DIMENSION + 1:]):
+        np.bitwise_or(codes, bit, out=codes, where=original_language == language)
 
+    # Skip the compaction copy when every movie has a known genre
+    if keep.all():
+        return codes, all_items
 
-def build_index(matrix: np.ndarray, metric: str = 'hamming', n_trees: int = 20, n_jobs: int = 4) -> 'JakubeIndexType':
-    """Build a Jakube index from a feature matrix."""
+    retained_items = [movie for movie, kept in zip(all_items, keep) if kept]
+
+    return codes[keep], retained_items
+
+
+def unpack_codes(codes: np.ndarray) -> np.ndarray:
+    """Expand packed uint32 codes back into an (N, TOTAL_DIMENSION) 0/1 matrix."""
+    return ((codes[:, None] & FEATURE_BITS) != 0).astype(np.int32)
+
+
+def build_index(codes: np.ndarray, metric: str = 'hamming', n_trees: int = 20, n_jobs: int = 4) -> 'JakubeIndexType':
+    """Build a Jakube index from packed feature codes."""
     from jakube import (
         AngularIndex,
         DotProductIndex,
@@ -161,20 +165,28 @@ def build_index(matrix: np.ndarray, metric: str = 'hamming', n_trees: int = 20,
 
     # Default to HammingIndex if metric is unrecognized
     IndexClass = METRIC_MAP.get(metric.lower(), HammingIndex)
-    dims = matrix.shape[1]
 
     if IndexClass != HammingIndex and metric.lower() == 'hamming':
         print(f"Warning: Hamming metric specified but HammingIndex class not found. Falling back.")
-    elif IndexClass == HammingIndex:
-        print(f"Using HammingIndex for {dims} dimensions (19 genres + 1 popularity + 4 languages).")
+
+    if IndexClass == HammingIndex:
+        print(f"Using HammingIndex for {TOTAL_DIMENSION} dimensions (19 genres + 1 popularity + 4 languages).")
+        # Each code is already the single int32 word Jakube's Hamming metric expects
+        matrix = codes.view(np.int32).reshape(-1, PACKED_DIMENSION)
+        dims = PACKED_DIMENSION
+    else:
+        # Vector metrics need one value per feature
+        matrix = unpack_codes(codes)
+        dims = TOTAL_DIMENSION
 
     index = IndexClass(dims)
 
     # Simple loop to add items
     # The expensive part is index.build(), which is already multi-threaded
-    for idx, row in enumerate(matrix):
-        # Add item requires a list of integers for Hamming
-        index.add_item(idx, row.tolist())
+    # Add item requires a list of integers (it casts to std::vector), so the
+    # whole matrix is converted once rather than one row per call
+    for idx, row in enumerate(matrix.tolist()):
+        index.add_item(idx, row)
 
     # Build the trees using multiple threads (n_jobs)
     index.build(q=n_trees, n_threads=n_jobs)